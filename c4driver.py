@@ -37,6 +37,8 @@ a selected icon.  This is the icon that will appear after you push the custom ex
 
 
 """ Imports and dependencies """
+import copy
+import io
 import logging
 try:
     import PIL
@@ -46,13 +48,8 @@ except ImportError:
 import os
 import shutil
 import sys
-try:
-    import wget
-except ImportError:
-    wget = None
-    print("wget Library not installed.\nType 'python3 -m pip install wget' at the command prompt and try again.")
-    quit()
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 try:
@@ -66,13 +63,25 @@ from PIL import Image
 
 
 """ Constants """
+ARCHIVE_FILE_MODE = 0o100644  # Regular file, rw-r--r--, for driver file entries that are not written from a file on disk
+DEFAULT_IMAGE_SIZES = (16, 32, 70, 90, 300, 512, 1024)  # Sizes in pixels of default image files, 16 and 32 are the device icons
 DRIVER_FILE_EXTENSION = "c4z"
 DRIVER_XML_FILE = "driver.xml"
 EXPERIENCE_BUTTON_SCENARIO_DRIVER_URL = "http://drivers.control4.com/experience-button-scenario.c4z"
 EXPERIENCE_BUTTON_SCENARIO_NAME = "experience-button-scenario"
+ICONS_ARCHIVE_PATH = "www/icons"
 IMAGE_FILE_EXTENSION = "png"
+OLD_ICONS_ARCHIVE_PATH = "www/icons-old"
+SELECTED_IMAGE_SIZES = (70, 90, 300, 512, 1024)  # Sizes in pixels of selected image files
 TEMPLATE_DRIVER_FILE = "experience-button-scenario.c4z"
-ZIP_FILE_EXTENSION = "zip"
+ZIP_COMPRESS_LEVEL = 1  # Fastest deflate level, used for the driver files that are not png files
+
+""" Element paths, relative to the devicedata root element of the driver xml file """
+DISPLAY_ICONS_PATH = "capabilities/navigator_display_option/display_icons"
+
+""" Precompiled XPath expressions used on the driver xml file """
+# The icon state elements and every element below them, selected in a single pass over the document
+STATE_DESCENDANTS_XPATH = etree.XPath("/devicedata/" + DISPLAY_ICONS_PATH + "/state/descendant-or-self::*")
 
 
 """ Global variables """
@@ -89,46 +98,61 @@ def configure_logging(logging_file: str) -> None:
     LOGGING.addHandler(file_handler)
 
 
-def make_image_files(in_file: str, out_file_prefix: str) -> None:
-    if os.path.exists(in_file):
-        im = Image.open(in_file)
-        LOGGING.info("Using image file: " + in_file + " - image format is: " + im.format + ", size is:" + str(im.size))
-        size_list = [16, 32, 70, 90, 300, 512, 1024]  # Sizes in pixels of image files to be created
-        for sz in size_list:
-            size = (sz, sz)
-            # Outfile prefix will be default or selected
-            out_file = out_file_prefix + "_" + str(sz) + "." + IMAGE_FILE_EXTENSION
-            LOGGING.info("Creating: " + out_file)
-            if in_file != out_file:
-                try:
-                    new_image = im.resize(size)
-                    new_image.save(out_file, IMAGE_FILE_EXTENSION)
-                except OSError:
-                    mesg = "Cannot create resized image for {0}.".format(in_file)
-                    print(mesg)
-                    LOGGING.error(mesg)
-
-
-def process_xml_file(file_name: str, driver_name: str, driver_label: str, update_driver: bool) -> None:
+def load_image_file(in_file: str) -> Image.Image:
+    im = Image.open(in_file)
+    LOGGING.info("Using image file: " + in_file + " - image format is: " + im.format + ", size is:" + str(im.size))
+    # Decode and convert the image once here so it can be shared by both sets of icon files
+    return im.convert("RGBA")
+
+
+def make_image_files(im: Image.Image, out_file_prefix: str, size_list: tuple) -> None:
+    # Resize from the largest size down, each size is made from the previous (larger) one rather than the original
+    src_image = im
+    for sz in sorted(size_list, reverse=True):
+        size = (sz, sz)
+        # Outfile prefix will be default or selected
+        out_file = out_file_prefix + "_" + str(sz) + "." + IMAGE_FILE_EXTENSION
+        LOGGING.info("Creating: " + out_file)
+        try:
+            new_image = src_image.resize(size, Image.LANCZOS)
+            new_image.save(out_file, IMAGE_FILE_EXTENSION)
+            src_image = new_image
+        except OSError:
+            mesg = "Cannot create resized image {0}.".format(out_file)
+            print(mesg)
+            LOGGING.error(mesg)
+
+
+def archive_compress_type(info: zipfile.ZipInfo) -> int:
+    # png files are already deflate compressed, compressing them again only costs time, folders have nothing to compress
+    if info.is_dir() or info.filename.lower().endswith("." + IMAGE_FILE_EXTENSION):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def process_xml_file(xml_data: bytes, driver_name: str, driver_label: str, update_driver: bool) -> bytes:
     current_time = datetime.now().strftime("%m/%d/%Y %H:%M")  # for creation and last modified date
-    tree = etree.parse(file_name)
+    tree = etree.parse(io.BytesIO(xml_data))
+    root = tree.getroot()
     if update_driver:
         pass
     else:
         # replace the name of the proxy, so it appears properly when first installed
-        tree.xpath("/devicedata/proxies/proxy")[0].attrib['name'] = driver_label.title().replace('_', ' ')
+        proxy_name = driver_label.title().replace('_', ' ')
+        root.find("proxies/proxy").attrib['name'] = proxy_name
         # replaces the name of the driver, so it's default description in system explorer will be the name of the driver
-        tree.xpath("/devicedata/name")[0].text = tree.xpath("/devicedata/proxies/proxy")[0].attrib['name'] + " - Experience Button"
+        root.find("name").text = proxy_name + " - Experience Button"
         # replaces the names of the icon files
-        for image_directory in tree.xpath("/devicedata/capabilities/navigator_display_option/display_icons/Icon"):
+        for image_directory in root.iterfind(DISPLAY_ICONS_PATH + "/Icon"):
             image_directory.text = image_directory.text.replace(EXPERIENCE_BUTTON_SCENARIO_NAME, driver_name)
-        for image_state in tree.xpath("/devicedata/capabilities/navigator_display_option/display_icons/state"):
-            for image_directory in image_state.iter():
+        for image_directory in STATE_DESCENDANTS_XPATH(tree):
+            if image_directory.text:
                 image_directory.text = image_directory.text.replace(EXPERIENCE_BUTTON_SCENARIO_NAME, driver_name)
-    tree.xpath("/devicedata/created")[0].text = current_time  # replaces the created date
-    tree.xpath("/devicedata/modified")[0].text = current_time  # replaces the modified
-    tree.xpath("/devicedata/version")[0].text = str(int(tree.xpath("/devicedata/version")[0].text) + 1)  # update the version
-    tree.write(file_name, pretty_print=True, xml_declaration=True, encoding="utf-8")
+    root.find("created").text = current_time  # replaces the created date
+    root.find("modified").text = current_time  # replaces the modified
+    version = root.find("version")
+    version.text = str(int(version.text) + 1)  # update the version
+    return etree.tostring(tree, pretty_print=True, xml_declaration=True, encoding="UTF-8")
 
 
 def main() -> None:
@@ -138,7 +162,6 @@ def main() -> None:
 
     # Define constants
     orig_driver_name = TEMPLATE_DRIVER_FILE  # This file must exist in the base folder
-    out_dir = "tempdir"  # Temporary folder to hold unzipped original C4Z file and image files.
     image_path = "temp_image"  # Temporary folder to hold the icon files
     driver_name = sys.argv[1]  # The icon file name passed in the command line
     driver_label = driver_name
@@ -161,6 +184,11 @@ def main() -> None:
         LOGGING.info(mesg)
         update_driver = True
     else:
+        try:
+            import wget  # Only needed to download the template driver for first-time creation
+        except ImportError:
+            print("wget Library not installed.\nType 'python3 -m pip install wget' at the command prompt and try again.")
+            quit()
         wget.download(EXPERIENCE_BUTTON_SCENARIO_DRIVER_URL, bar=None, out=orig_driver_name)
         if not (os.path.exists(orig_driver_name)):
             sys.exit("No file called experience-button-scenario.c4z in current directory.  Aborting.")
@@ -171,33 +199,56 @@ def main() -> None:
     if not (os.path.exists(base_selected_file)):  # Look to see if there is a selected file
         base_selected_file = orig_image_file  # If there isn't then just use the default file
         LOGGING.info("No selected image file so using the same image file for both default and selected")
-    # This is the driver file with xml code - it will be slightly altered
-    xml_file_name = os.path.join(out_dir, DRIVER_XML_FILE)
+    default_image = load_image_file(orig_image_file)
+    if base_selected_file == orig_image_file:
+        selected_image = default_image  # Both resize jobs only read from the image, so it can be shared
+    else:
+        selected_image = load_image_file(base_selected_file)
     Path(image_path).mkdir(parents=True, exist_ok=True)  # Create the temporary folder for the icon files
     default_image_path = os.path.join(image_path, "default")  # Path name for selected icon images
     selected_image_path = os.path.join(image_path, "selected")  # Path name for default icon images
-    make_image_files(orig_image_file, default_image_path)  # Make all the default files
-    make_image_files(base_selected_file, selected_image_path)  # Make all the selected files
-    zipfile.ZipFile(orig_driver_name).extractall(path=out_dir)  # Extracts driver file to the path given
-    # Processes xml to change icon names for buttons and xml parameters - name, created and modified
-    process_xml_file(xml_file_name, driver_name, driver_label, update_driver)
-    old_icon_path = os.path.join(out_dir, "www", "icons-old")
-    if os.path.exists(old_icon_path):
-        shutil.rmtree(old_icon_path)  # Remove icons-old folder if it exists - no one knows why this folder exists - lazy coder?
-    # Move the device small and large icons to the driver file
-    shutil.move(os.path.join(image_path, "default_16.png"), os.path.join(out_dir, "www", "icons", "device_sm.png"))
-    shutil.move(os.path.join(image_path, "default_32.png"), os.path.join(out_dir, "www", "icons", "device_lg.png"))
-    # These files weren't needed; it was easier to create them in a loop and then delete
-    os.remove(os.path.join(image_path, "selected_16.png"))
-    os.remove(os.path.join(image_path, "selected_32.png"))
-    # Copy all the icon files to the proper folder
-    for file in Path(image_path).glob("*." + IMAGE_FILE_EXTENSION):
-        shutil.copy(file, os.path.join(out_dir, "www", "icons", "device"))
+    # Make all the default and selected files, Pillow releases the GIL while resizing and encoding so run both at once
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        image_jobs = [executor.submit(make_image_files, default_image, default_image_path, DEFAULT_IMAGE_SIZES),
+                      executor.submit(make_image_files, selected_image, selected_image_path, SELECTED_IMAGE_SIZES)]
+        for image_job in image_jobs:
+            image_job.result()
+    # The device small and large icons go in the icons folder, all the other icon files go in the device folder
+    icon_files = {os.path.join(image_path, "default_16.png"): ICONS_ARCHIVE_PATH + "/device_sm.png",
+                  os.path.join(image_path, "default_32.png"): ICONS_ARCHIVE_PATH + "/device_lg.png"}
+    with os.scandir(image_path) as image_entries:
+        for entry in image_entries:
+            if entry.name.endswith("." + IMAGE_FILE_EXTENSION) and entry.path not in icon_files:
+                icon_files[entry.path] = ICONS_ARCHIVE_PATH + "/device/" + entry.name
+    replaced_entries = set(icon_files.values())
+    replaced_entries.add(DRIVER_XML_FILE)
+    with zipfile.ZipFile(orig_driver_name) as driver_zip:
+        # Processes xml to change icon names for buttons and xml parameters - name, created and modified
+        xml_data = process_xml_file(driver_zip.read(DRIVER_XML_FILE), driver_name, driver_label, update_driver)
+    xml_info = zipfile.ZipInfo(DRIVER_XML_FILE, date_time=datetime.now().timetuple()[:6])
+    xml_info.external_attr = ARCHIVE_FILE_MODE << 16
+    # Copy the original driver file into the new one, swapping in the changed xml file and the new icon files.
+    # The new driver is built under a temporary name, so the existing driver is never left half written on an update.
+    temp_c4z_file_name = final_c4z_image_file_name + ".tmp"
+    try:
+        with zipfile.ZipFile(orig_driver_name) as driver_zip, \
+                zipfile.ZipFile(temp_c4z_file_name, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESS_LEVEL) as new_zip:
+            for info in driver_zip.infolist():
+                # Leave out the icons-old folder if it exists - no one knows why this folder exists - lazy coder?
+                if info.filename in replaced_entries or info.filename.startswith(OLD_ICONS_ARCHIVE_PATH + "/"):
+                    continue
+                # Write a copy of the entry info, writestr() changes it and it still belongs to the open original driver
+                new_zip.writestr(copy.copy(info), driver_zip.read(info), compress_type=archive_compress_type(info),
+                                 compresslevel=ZIP_COMPRESS_LEVEL)
+            new_zip.writestr(xml_info, xml_data, compress_type=archive_compress_type(xml_info),
+                             compresslevel=ZIP_COMPRESS_LEVEL)
+            for file, arcname in icon_files.items():
+                new_zip.write(file, arcname=arcname, compress_type=archive_compress_type(zipfile.ZipInfo(arcname)))
+        os.replace(temp_c4z_file_name, final_c4z_image_file_name)
+    finally:
+        if os.path.exists(temp_c4z_file_name):
+            os.remove(temp_c4z_file_name)  # Only left behind if building the new driver failed
     shutil.rmtree(image_path)  # Remove the temporary folder for the resized image files
-    # Make the zip file, have to use zip as an extension
-    shutil.make_archive(driver_name, ZIP_FILE_EXTENSION, os.path.join(os.getcwd(), out_dir))
-    shutil.rmtree(out_dir)  # Remove the folder for the resized image files
-    shutil.move(driver_name + "." + ZIP_FILE_EXTENSION, final_c4z_image_file_name)  # Rename zip to final driver name
     if not update_driver:
         os.remove(orig_driver_name)
         LOGGING.info(final_c4z_image_file_name + " driver file created.")